@@ -1,16 +1,21 @@
 # Get the job
+import copy
+import hashlib
+import json
 import logging
+import os
 from dataclasses import dataclass
+from functools import lru_cache
+from importlib.util import find_spec
+import numpy as np
 import pandas as pd
-from xtgeo import gridproperty_from_roxar, surface_from_roxar, RoxUtils
-from fmu.dataio import ExportData
-from fmu.config.utilities import yaml_load
-import roxar
-import roxar.jobs
 
-logging.basicConfig(level="DEBUG")
 logger = logging.getLogger("Inplace")
 
+__all__ = ["RmsInplaceVolumes", "get_volumetrics", "get_job_arguments", "clear_caches"]
+
+CONFIG_PATH = "../../fmuconfig/output/global_variables.yml"
+
 RENAME_VOLUMES = {
     "Proj. real.": "REAL",
     "Zone": "ZONE",
@@ -34,11 +39,145 @@ RENAME_VOLUMES = {
 }
 
 
+@lru_cache(maxsize=100)
+def _cached_yaml_load(path, mtime, size):
+    """Load yaml config, cached on path, modification time and size
+
+    Args:
+        path (str): absolute path to config file
+        mtime (int): modification time of file in ns, used for invalidation
+        size (int): size of file, used for invalidation
+
+    Returns:
+        dict: the parsed config
+    """
+    logger.debug("\nReading config from %s", path)
+    return _load_config_fast(path)
+
+
+def _load_config_fast(config_path):
+    """Load yaml config via a json sidecar made from the same yaml content
+
+    Args:
+        config_path (str): path to yaml config file
+
+    Returns:
+        dict: the parsed config
+    """
+    from fmu.config.utilities import yaml_load
+
+    cache_path = config_path + ".cache.json"
+    with open(config_path, "rb") as stream:
+        source_hash = hashlib.sha256(stream.read()).hexdigest()
+    try:
+        with open(cache_path, "r", encoding="utf-8") as stream:
+            cached = json.load(stream)
+        if cached["source_hash"] == source_hash:
+            logger.debug("Reading config from sidecar %s", cache_path)
+            return cached["config"]
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError, TypeError, KeyError):
+        logger.debug("Ignoring unreadable config sidecar %s", cache_path)
+
+    config = yaml_load(config_path)
+    try:
+        dumped = json.dumps(config)
+    except (TypeError, ValueError):
+        logger.debug("Config %s cannot be stored as json", config_path)
+        return config
+    # json turns e.g. integer keys into strings, only keep exact copies
+    if json.loads(dumped) != config:
+        logger.debug("Config %s does not survive json round trip", config_path)
+        return config
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as stream:
+            json.dump({"source_hash": source_hash, "config": config}, stream)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        logger.warning("Could not write config sidecar %s", cache_path)
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return config
+
+
+def _load_config(config_path):
+    """Load yaml config, reusing the parsed result while the file is unchanged
+
+    Args:
+        config_path (str): path to config file
+
+    Returns:
+        dict: copy of the parsed config
+    """
+    stats = os.stat(config_path)
+    config = _cached_yaml_load(
+        os.path.abspath(config_path), stats.st_mtime_ns, stats.st_size
+    )
+    return copy.deepcopy(config)
+
+
+def _make_exporter(config_path, parent):
+    """Make exporter for objects belonging to parent
+
+    Args:
+        config_path (str): path to config file
+        parent (str): name of parent for exported objects
+
+    Returns:
+        fmu.dataio.ExportData: the exporter
+    """
+    from fmu.dataio import ExportData
+
+    return ExportData(config=_load_config(config_path), parent=parent)
+
+
 def _get_project(project, readonly):
+    from xtgeo import RoxUtils
+
     project = RoxUtils(project, readonly=readonly).project
     return project
 
 
+@lru_cache(maxsize=32)
+def _cached_job_arguments(owner, job_type, job_name):
+    """Fetch arguments of rms job, cached on job identity
+
+    Args:
+        owner (tuple): owner path of job
+        job_type (str): type of job
+        job_name (str): name of job
+
+    Returns:
+        dict: the job arguments
+    """
+    import roxar.jobs
+
+    job = roxar.jobs.Job.get_job(owner=list(owner), type=job_type, name=job_name)
+    return job.get_arguments()
+
+
+def get_job_arguments(owner, job_type, job_name):
+    """Get arguments of rms job, reusing earlier fetches of the same job
+
+    Args:
+        owner (list): owner path of job, e.g. ["Grid models", "Geogrid", "Grid"]
+        job_type (str): type of job
+        job_name (str): name of job
+
+    Returns:
+        dict: copy of the job arguments
+    """
+    return copy.deepcopy(_cached_job_arguments(tuple(owner), job_type, job_name))
+
+
+def clear_caches():
+    """Clear cached job arguments and configs"""
+    _cached_job_arguments.cache_clear()
+    _cached_yaml_load.cache_clear()
+
+
 def _define_prefixes(out_input):
     """Define prefixes that could be used
 
@@ -73,19 +212,24 @@ def _define_output(out_input, selectors):
     out_location = out_input["MapOutput"].lower()
     calculations = out_input["Calculations"]
     prefixes = _define_prefixes(out_input)
-    properties = []
-    maps = []
-    for calculation in calculations:
-        for prfx in prefixes:
-            if calculation["CreateProperty"]:
-                properties.append(prfx + calculation["Type"].lower())
-            if calculation["CreateZoneMap"]:
-                maps.append(prfx + calculation["Type"].upper())
+    properties = [
+        prfx + calculation["Type"].lower()
+        for calculation in calculations
+        if calculation["CreateProperty"]
+        for prfx in prefixes
+    ]
+    maps = [
+        prfx + calculation["Type"].upper()
+        for calculation in calculations
+        if calculation["CreateZoneMap"]
+        for prfx in prefixes
+    ]
     collated = {
         "maps": maps,
         "properties": properties,
         "map_location": out_location,
         "map_subfolders": selectors["Zone"]["filters"],
+        "zones": selectors["Zone"]["filters"],
     }
     logger.debug("\nReturning %s", collated)
     return collated
@@ -103,19 +247,20 @@ def _define_variables(variables_input):
     logger.debug("\nExtracting variables from %s", variables_input)
     var_definitions = {}
     variable_parameters = []
+    seen = set()
     for var_group in variables_input.values():
         for variable in var_group:
             name = variable["Name"]
-            source = variable["InputSource"]
             table_values = variable["TableValues"]
-            if variable["DataInput"]:
-                propname = variable["DataInput"][0][-1]
+            data_input = variable["DataInput"]
+            if data_input:
+                propname = data_input[0][-1]
                 table_values = {"property": propname}
-                if propname not in variable_parameters:
+                if propname not in seen:
+                    seen.add(propname)
                     variable_parameters.append(propname)
-            else:
-                if source == "REGION_MODEL":
-                    table_values = "hidden"
+            elif variable["InputSource"] == "REGION_MODEL":
+                table_values = "hidden"
             var_definitions[name] = {
                 "applies": variable["InputType"],
                 "values": table_values,
@@ -138,12 +283,13 @@ def _define_selectors(in_dict):
     possible_selectors = ["Zone", "Region", "Facies"]
     selectors = {}
     for key in possible_selectors[1:]:
-        try:
+        parameter = in_dict.get(f"{key}Property")
+        if parameter:
             selectors[key] = {
-                "filters": in_dict[f"Selected{key}Names"],
-                "parameter": in_dict[f"{key}Property"][-1],
+                "filters": in_dict.get(f"Selected{key}Names", []),
+                "parameter": parameter[-1],
             }
-        except IndexError:
+        else:
             logger.warning("No selectors for %s", key)
 
     selectors.update(
@@ -156,6 +302,82 @@ def _define_selectors(in_dict):
     return selectors
 
 
+def _get_zone_cell_numbers(project, parent, zone_names):
+    """Find cell numbers of defined cells in selected zones
+
+    Args:
+        project (roxar.Project): the project to read from
+        parent (str): name of grid model
+        zone_names (list): names of zones to include
+
+    Returns:
+        tuple: cell numbers and grid indexer, cell numbers are None when
+               all cells are needed
+    """
+    grid = project.grid_models[parent].get_grid()
+    indexer = grid.grid_indexer
+    if not zone_names or set(grid.zone_names) <= set(zone_names):
+        return None, indexer
+    ncol, nrow, _ = indexer.dimensions
+    cell_numbers = []
+    for zone_index, zone_name in enumerate(grid.zone_names):
+        if zone_name not in zone_names:
+            continue
+        for layer_range in indexer.zonation[zone_index]:
+            cell_numbers.append(
+                indexer.get_cell_numbers_in_range(
+                    (0, 0, layer_range.start),
+                    (ncol, nrow, layer_range.stop),
+                )
+            )
+    if not cell_numbers:
+        logger.warning(
+            "None of zones %s found in %s, reading all cells", zone_names, parent
+        )
+        return None, indexer
+    cell_numbers = np.concatenate(cell_numbers)
+    logger.debug("Found %i cells in zones %s", cell_numbers.size, zone_names)
+    return cell_numbers, indexer
+
+
+def _get_property_subset(project, parent, name, cell_numbers, indexer):
+    """Get grid property with values only read for given cells
+
+    Args:
+        project (roxar.Project): the project to read from
+        parent (str): name of grid model
+        name (str): name of property
+        cell_numbers (np.ndarray): cells to read, None means all cells
+        indexer (roxar.grids.GridIndexer): indexer of grid
+
+    Returns:
+        xtgeo.GridProperty: property with cells outside selection masked
+    """
+    import roxar
+    from xtgeo import GridProperty, gridproperty_from_roxar
+
+    if cell_numbers is None:
+        return gridproperty_from_roxar(project, parent, name)
+    rox_prop = project.grid_models[parent].properties[name]
+    discrete = rox_prop.type == roxar.GridPropertyType.discrete
+    # Same value types as xtgeo uses when reading the full property
+    dtype = np.int32 if discrete else np.float64
+    values = rox_prop.get_values(cell_numbers=cell_numbers)
+    dimensions = indexer.dimensions
+    full = np.ma.masked_all(dimensions, dtype=dtype)
+    ijk = indexer.get_indices(cell_numbers)
+    full[ijk[:, 0], ijk[:, 1], ijk[:, 2]] = values.astype(dtype)
+    return GridProperty(
+        ncol=dimensions[0],
+        nrow=dimensions[1],
+        nlay=dimensions[2],
+        values=full,
+        name=name,
+        discrete=discrete,
+        codes=dict(rox_prop.code_names) if discrete else None,
+    )
+
+
 def get_volumetrics(report_params, project):
     """Get volumetrics table
 
@@ -167,77 +389,220 @@ def get_volumetrics(report_params, project):
     """
     logger.debug("\nGetting volumes reading %s", report_params)
     try:
-        volumes = pd.DataFrame.from_dict(
+        columns = (
             project.volumetric_tables[report_params[0]["ReportTableName"]]
             .get_data_table()
             .to_dict()
         )
-        logger.debug("Volumes before renaming %s", volumes.head(2))
-        volumes.rename(columns=RENAME_VOLUMES, inplace=True)
-        logger.debug("Volumes after renaming %s", volumes.head(2))
-        volumes.drop("REAL", axis=1, inplace=True)
+        # Leave out the realisation column before building the frame, so
+        # the data is never held twice while selecting columns
+        columns.pop("Proj. real.", None)
+        volumes = pd.DataFrame(
+            {name: np.asarray(values) for name, values in columns.items()},
+            copy=False,
+        )
+        del columns
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Volumes before renaming %s", volumes.head(2))
+        volumes.columns = [RENAME_VOLUMES.get(name, name) for name in volumes.columns]
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Volumes after renaming %s", volumes.head(2))
     except KeyError:
         logger.warning("No volume table attached")
         volumes = None
     return volumes
 
 
+def _surface_from_item(item, name):
+    """Make xtgeo surface from surface item in roxar folder
+
+    surface_from_roxar resolves the folder path again for every surface,
+    this reads the surface from an already resolved folder. The data
+    itself is still read with one get_grid call per surface.
+
+    Args:
+        item (roxar surface item): the item to convert
+        name (str): name of surface
+
+    Returns:
+        xtgeo.RegularSurface: the surface
+    """
+    from xtgeo import RegularSurface
+
+    grid = item.get_grid()
+    ncol, nrow = grid.dimensions
+    return RegularSurface(
+        ncol=ncol,
+        nrow=nrow,
+        xori=grid.origin[0],
+        yori=grid.origin[1],
+        xinc=grid.increment[0],
+        yinc=grid.increment[1],
+        rotation=grid.rotation,
+        values=grid.get_values(),
+        name=name,
+    )
+
+
+def _export_surface(project, exd, map_name, folder_name, stype, job_name, folder):
+    """Fetch and export one surface
+
+    Args:
+        project (roxar.Project): the project to read from
+        exd (fmu.dataio.ExportData): exporter to use
+        map_name (str): name of surface
+        folder_name (str): folder of surface
+        stype (str): surface location in project
+        job_name (str): name of job, used as tagname
+        folder (roxar folder container): resolved folder, None means look up
+                                         through surface_from_roxar
+
+    Returns:
+        int: number of objects exported
+    """
+    from xtgeo import surface_from_roxar
+
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(
+            "Fetching surface with name: %s, folder: %s", map_name, folder_name
+        )
+    if folder is not None:
+        if map_name not in folder:
+            logger.warning("No surface called %s", map_name)
+            return 0
+        surf = _surface_from_item(folder[map_name], map_name)
+    else:
+        try:
+            surf = surface_from_roxar(project, map_name, folder_name, stype=stype)
+        except KeyError:
+            logger.warning("No surface called %s", map_name)
+            return 0
+    logger.debug(
+        "Exporting %s",
+        exd.export(surf, name=map_name, tagname=job_name, content="property"),
+    )
+    return 1
+
+
+def _export_folder(project, exd, maps, folder_name, stype, job_name):
+    """Fetch and export all surfaces in one folder
+
+    Args:
+        project (roxar.Project): the project to read from
+        exd (fmu.dataio.ExportData): exporter to use
+        maps (list): names of surfaces
+        folder_name (str): folder of surfaces
+        stype (str): surface location in project
+        job_name (str): name of job, used as tagname
+
+    Returns:
+        int: number of objects exported
+    """
+    folder = None
+    if stype in ("clipboard", "general2d_data"):
+        try:
+            folder = getattr(project, stype).folders[folder_name.split("/")]
+        except KeyError:
+            logger.warning("No folder called %s", folder_name)
+            return 0
+    return sum(
+        _export_surface(project, exd, map_name, folder_name, stype, job_name, folder)
+        for map_name in maps
+    )
+
+
+def _export_property(project, exd, parent, property_name, job_name, cells):
+    """Fetch and export one grid property
+
+    Args:
+        project (roxar.Project): the project to read from
+        exd (fmu.dataio.ExportData): exporter to use
+        parent (str): name of grid model
+        property_name (str): name of property
+        job_name (str): name of job, used as tagname
+        cells (tuple): cell numbers and grid indexer from _get_zone_cell_numbers,
+                       (None, None) reads the full property
+
+    Returns:
+        int: number of objects exported
+    """
+    logger.debug("Will be exporting %s for %s", property_name, parent)
+    if property_name not in project.grid_models[parent].properties:
+        logger.warning("No parameter called %s", property_name)
+        return 0
+    prop = _get_property_subset(project, parent, property_name, *cells)
+    logger.debug(
+        "Exporting %s",
+        exd.export(prop, name=property_name, tagname=job_name, content="property"),
+    )
+    return 1
+
+
+def _export_table(exd, table, parent, job_name):
+    """Export volumes table, as parquet when pyarrow is available
+
+    Args:
+        exd (fmu.dataio.ExportData): exporter to use
+        table (pd.DataFrame): the volumes
+        parent (str): name of grid model
+        job_name (str): name of job, used as tagname
+
+    Returns:
+        int: number of objects exported
+    """
+    export_args = {
+        "parent": parent,
+        "name": "volumes",
+        "tagname": job_name,
+        "content": "volumetrics",
+    }
+    if find_spec("pyarrow") is not None:
+        table_fformat = "parquet"
+    else:
+        logger.warning("pyarrow not available, exporting volumes as csv")
+        table_fformat = "csv"
+    logger.debug(
+        "Exporting %s",
+        exd.export(table, table_fformat=table_fformat, **export_args),
+    )
+    return 1
+
+
 def _export_collection(
     project,
     collection,
     parent,
     job_name,
-    config_path="../../fmuconfig/output/global_variables.yml",
+    exd=None,
+    config_path=CONFIG_PATH,
 ):
-    config = yaml_load(config_path)
-    exd = ExportData(config=config, parent=parent)
+    if exd is None:
+        exd = _make_exporter(config_path, parent)
+    stype = collection["map_location"]
+    folders = [
+        f"Volumetrics_{job_name}/{folder_name}"
+        for folder_name in collection["map_subfolders"]
+    ]
     count = 0
-    for map_name in collection["maps"]:
-        for folder_name in collection["map_subfolders"]:
-            folder_name = f"Volumetrics_{job_name}/{folder_name}"
-            logger.debug(
-                "Fetching surface with name: %s, folder: %s", map_name, folder_name
+    if collection["maps"]:
+        for folder in folders:
+            count += _export_folder(
+                project, exd, collection["maps"], folder, stype, job_name
             )
-            try:
-                surf = surface_from_roxar(
-                    project, map_name, folder_name, stype=collection["map_location"]
-                )
-                logger.debug(
-                    "Exporting %s",
-                    exd.export(
-                        surf, name=map_name, tagname=job_name, content="property"
-                    ),
-                )
-
-                count += 1
-            except KeyError:
-                logger.warning("No surface called %s", map_name)
-    for property_name in collection["properties"]:
-        logger.debug("Will be exporting %s for %s", property_name, parent)
-        try:
-            prop = gridproperty_from_roxar(project, parent, property_name)
-            logger.debug(
-                "Exporting %s",
-                exd.export(
-                    prop, name=property_name, tagname=job_name, content="property"
-                ),
+    if collection["properties"]:
+        cells = _get_zone_cell_numbers(project, parent, collection["zones"])
+        for property_name in collection["properties"]:
+            count += _export_property(
+                project, exd, parent, property_name, job_name, cells
             )
-            count += 1
-        except ValueError:
-            logger.warning("No parameter called %s", property_name)
+    # Input properties are exported in full, not only for the selected zones
+    for property_name in collection.get("input_properties", []):
+        count += _export_property(
+            project, exd, parent, property_name, job_name, (None, None)
+        )
     try:
         if collection["table"] is not None:
-            logger.debug(
-                "Exporting %s",
-                exd.export(
-                    collection["table"],
-                    parent=parent,
-                    name="volumes",
-                    tagname=job_name,
-                    content="volumetrics",
-                ),
-            )
-            count += 1
+            count += _export_table(exd, collection["table"], parent, job_name)
         else:
             logger.warning(
                 "No volumes exported, have you forgot to select table option?"
@@ -258,13 +623,12 @@ class RmsInplaceVolumes:
 
     def __post_init__(self):
         """Initialize what is not initialized upfront"""
-        job = roxar.jobs.Job.get_job(
-            owner=["Grid models", self.grid_name, "Grid"],
-            type="Volumetrics",
-            name=self.job_name,
-        )
+        # Jobs may have been edited since the last instance was made
+        clear_caches()
         self.project = _get_project(self.project, True)
-        self.params = job.get_arguments()
+        self.params = get_job_arguments(
+            ["Grid models", self.grid_name, "Grid"], "Volumetrics", self.job_name
+        )
         self.input = self.params["Input"][0]
         self.output = self.params["Output"][0]
         self.variables = self.params["Variables"][0]
@@ -273,11 +637,19 @@ class RmsInplaceVolumes:
         self.selectors = _define_selectors(self.input)
         self.report_output = _define_output(self.output, self.selectors)
         self.input_variables, additional_props = _define_variables(self.variables)
-        self.report_output["properties"].extend(additional_props)
+        self.report_output["input_properties"] = additional_props
         logger.debug(self.report_output["properties"])
+        logger.debug(self.report_output["input_properties"])
         self.report_output["table"] = self.report
+        self.exporter = None
 
     def export(self):
+        if self.exporter is None:
+            self.exporter = _make_exporter(CONFIG_PATH, self.grid_name)
         _export_collection(
-            self.project, self.report_output, self.grid_name, self.job_name
+            self.project,
+            self.report_output,
+            self.grid_name,
+            self.job_name,
+            exd=self.exporter,
         )